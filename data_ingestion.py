@@ -1,16 +1,21 @@
 import argparse
-import json
+import functools
 import os
-import tempfile
-from datetime import datetime, timezone
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 
 import openmeteo_requests
 from openmeteo_sdk.WeatherApiResponse import WeatherApiResponse
-import requests
+import numpy as np
+from requests.adapters import HTTPAdapter
 import pandas as pd
 import requests_cache
 from retry_requests import retry
 import snowflake.connector
+from snowflake.connector.pandas_tools import write_pandas
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -23,11 +28,32 @@ LOCATIONS = [
     "Daniel Boone National Forest, USA",
 ]
 
+# Grid points per Open-Meteo request; ~50 URL characters each keeps a batch well under common 8 KB limits
+_WEATHER_BATCH_SIZE = 100
 
+_CLIENT_LOCK = threading.Lock()
+
+
+def _has_nominatim_results(response):
+    """Cache filter: Nominatim answers a miss with 200 and an empty list, which must not be kept for a month."""
+    return response.content.strip() != b"[]"
+
+
+# Bounding boxes for named places are effectively static, so they are cached for a month
+_NOMINATIM_SESSION = requests_cache.CachedSession(
+    ".nominatim_cache", expire_after=timedelta(days=30), filter_fn=_has_nominatim_results
+)
+_NOMINATIM_SESSION.headers.update({"User-Agent": "weather-pipeline"})
+_NOMINATIM_SESSION.mount("https://", HTTPAdapter(pool_connections=16, pool_maxsize=16))
+
+
+@functools.lru_cache(maxsize=128)
 def get_bbox(location):
-    """Get bounding box from Nominatim for a (city, state) tuple or free-form string."""
+    """Get bounding box from Nominatim for a (city, state) tuple or free-form string.
+
+    Memoized per process, so callers must not mutate the returned dict.
+    """
     url = "https://nominatim.openstreetmap.org/search"
-    headers = {"User-Agent": "weather-pipeline"}
 
     if isinstance(location, tuple):
         city, state = location
@@ -35,7 +61,11 @@ def get_bbox(location):
     else:
         params = {"q": location, "format": "json", "limit": 1}
 
-    resp = requests.get(url, params=params, headers=headers)
+    resp = _NOMINATIM_SESSION.get(url, params=params)
+    resp.raise_for_status()
+    if not getattr(resp, "from_cache", False):
+        # Nominatim's usage policy allows at most one request per second
+        time.sleep(1)
     result = resp.json()[0]
     bbox = result["boundingbox"]
     return {
@@ -46,15 +76,23 @@ def get_bbox(location):
     }
 
 
-def _get_client():
-    cache_session = requests_cache.CachedSession(".cache", expire_after=3600)
+def _get_client(expire_after=timedelta(hours=1)):
+    """Return a shared Open-Meteo client whose cached session expires responses after expire_after."""
+    # lru_cache alone lets concurrent first calls each build a session, so serialize them
+    with _CLIENT_LOCK:
+        return _build_client(expire_after)
+
+
+@functools.lru_cache(maxsize=None)
+def _build_client(expire_after):
+    cache_session = requests_cache.CachedSession(".cache", backend="sqlite", wal=True, expire_after=expire_after)
     retry_session = retry(cache_session, retries=5, backoff_factor=0.2)
     return openmeteo_requests.Client(session=retry_session)
 
 
 def get_grid_points(box):
     """Resolve bounding box to a list of grid lat/lon points via the Best Match model."""
-    openmeteo = _get_client()
+    openmeteo = _get_client(expire_after=timedelta(days=7))
     url = "https://api.open-meteo.com/v1/forecast"
     params = {
         "bounding_box": f"{box['south_lat']},{box['west_lon']},{box['north_lat']},{box['east_lon']}",
@@ -76,8 +114,6 @@ def get_weather(latitudes, longitudes, mode="history"):
     openmeteo = _get_client()
     url = "https://api.open-meteo.com/v1/forecast"
     params = {
-        "latitude": latitudes,
-        "longitude": longitudes,
         "hourly": ["temperature_2m", "is_day", "precipitation_probability", "precipitation"],
         "wind_speed_unit": "mph",
         "temperature_unit": "fahrenheit",
@@ -91,33 +127,51 @@ def get_weather(latitudes, longitudes, mode="history"):
         params["past_hours"] = 0
         params["forecast_hours"] = 2
 
-    responses = openmeteo.weather_api(url, params=params)
+    responses = []
+    for i in range(0, len(latitudes), _WEATHER_BATCH_SIZE):
+        batch = {
+            **params,
+            "latitude": latitudes[i:i + _WEATHER_BATCH_SIZE],
+            "longitude": longitudes[i:i + _WEATHER_BATCH_SIZE],
+        }
+        responses.extend(openmeteo.weather_api(url, params=batch))
     return responses
 
 
-def parse_responses(responses: list[WeatherApiResponse], location_label):
-    """Parse Open-Meteo responses into a list of DataFrames."""
-    dataframes = []
-    for response in responses:
+def parse_responses(responses: list[WeatherApiResponse], labels: list[str]):
+    """Parse Open-Meteo responses into a list of column dicts (numpy arrays), tagging each with its location label."""
+    parsed = []
+    time_axis, forecast_timestamp = None, None
+    for response, location_label in zip(responses, labels):
         hourly = response.Hourly()
-        hourly_data = {
-            "forecast_timestamp": pd.date_range(
-                start=pd.to_datetime(hourly.Time(), unit="s", utc=True),
-                end=pd.to_datetime(hourly.TimeEnd(), unit="s", utc=True),
-                freq=pd.Timedelta(seconds=hourly.Interval()),
+        # Every point is requested with the same hours, so the index is normally built once
+        axis = (hourly.Time(), hourly.TimeEnd(), hourly.Interval())
+        if axis != time_axis:
+            time_axis = axis
+            start, end, interval = axis
+            forecast_timestamp = pd.date_range(
+                start=pd.to_datetime(start, unit="s", utc=True),
+                end=pd.to_datetime(end, unit="s", utc=True),
+                freq=pd.Timedelta(seconds=interval),
                 inclusive="left",
-            ),
+            )
+        # Variable order matches the "hourly" list requested in get_weather()
+        temperature_2m, is_day, precipitation_probability, precipitation = (
+            hourly.Variables(i).ValuesAsNumpy() for i in range(4)
+        )
+        hourly_data = {
+            "forecast_timestamp": forecast_timestamp,
             "location": location_label,
             "latitude": response.Latitude(),
             "longitude": response.Longitude(),
-            "temperature_2m": hourly.Variables(0).ValuesAsNumpy(),
-            "is_day": hourly.Variables(1).ValuesAsNumpy(),
-            "precipitation_probability": hourly.Variables(2).ValuesAsNumpy(),
-            "precipitation": hourly.Variables(3).ValuesAsNumpy(),
+            "temperature_2m": temperature_2m,
+            "is_day": is_day,
+            "precipitation_probability": precipitation_probability,
+            "precipitation": precipitation,
             "ingested_at": datetime.now(timezone.utc)
         }
-        dataframes.append(pd.DataFrame(data=hourly_data))
-    return dataframes
+        parsed.append(hourly_data)
+    return parsed
 
 
 def get_snowflake_connection():
@@ -132,81 +186,140 @@ def get_snowflake_connection():
     )
 
 
-def responses_to_json(dataframes: list[pd.DataFrame], location_label, mode):
-    """Serialize DataFrames to an NDJSON file (one JSON object per line), returns the file path."""
-    safe_label = location_label.replace(" ", "_").replace(",", "")
-    timestamp = datetime.now(timezone.utc).strftime("%Y%m%d_%H%M%S")
-    filename = f"{safe_label}_{mode}_{timestamp}.json"
-    filepath = os.path.join(tempfile.gettempdir(), filename)
-
-    with open(filepath, "w") as f:
-        for df in dataframes:
-            df_serializable = df.copy()
-            df_serializable["forecast_timestamp"] = df_serializable["forecast_timestamp"].astype(str)
-            df_serializable["ingested_at"] = df_serializable["ingested_at"].astype(str)
-            for record in df_serializable.to_dict(orient="records"):
-                record["mode"] = mode
-                f.write(json.dumps(record) + "\n")
-
-    return filepath
+def responses_to_dataframe(parsed: list[dict], mode):
+    """Concatenate parsed responses into a single DataFrame, one row per hourly record."""
+    rows_per_response = [len(hourly_data["forecast_timestamp"]) for hourly_data in parsed]
+    return pd.DataFrame(
+        data={
+            # Timestamps stay ISO-8601 UTC strings, which the dbt staging model casts with ::timestamp_ltz
+            "forecast_timestamp": np.datetime_as_string(
+                np.concatenate([hourly_data["forecast_timestamp"].values for hourly_data in parsed]),
+                unit="s",
+                timezone="UTC",
+            ),
+            "location": np.repeat([hourly_data["location"] for hourly_data in parsed], rows_per_response),
+            "latitude": np.repeat([hourly_data["latitude"] for hourly_data in parsed], rows_per_response),
+            "longitude": np.repeat([hourly_data["longitude"] for hourly_data in parsed], rows_per_response),
+            "temperature_2m": np.concatenate([hourly_data["temperature_2m"] for hourly_data in parsed]),
+            "is_day": np.concatenate([hourly_data["is_day"] for hourly_data in parsed]),
+            "precipitation_probability": np.concatenate(
+                [hourly_data["precipitation_probability"] for hourly_data in parsed]
+            ),
+            "precipitation": np.concatenate([hourly_data["precipitation"] for hourly_data in parsed]),
+            "ingested_at": np.repeat(
+                [hourly_data["ingested_at"].isoformat() for hourly_data in parsed], rows_per_response
+            ),
+            "mode": mode,
+        },
+        copy=False,
+    )
 
 
-def upload_to_snowflake(connection, local_path):
-    """PUT a local JSON file to the raw_weather table stage and COPY INTO the table."""
+def upload_to_snowflake(connection, df: pd.DataFrame):
+    """Stage a DataFrame into a session-scoped temporary table with write_pandas, then load it into raw_weather."""
+    # A temporary table is private to this connection, so overlapping runs can't clobber each other
+    write_pandas(
+        connection,
+        df,
+        table_name="RAW_WEATHER_STG",
+        auto_create_table=True,
+        table_type="temporary",
+        use_logical_type=True,
+        chunk_size=100000,
+        compression="snappy",
+        parallel=8,
+    )
     cur = connection.cursor()
     try:
-        cur.execute(f"PUT 'file://{local_path}' @%raw_weather AUTO_COMPRESS=TRUE")
-        # Use metadata start scan time for an accurate time value of record loading
         cur.execute(
-            "COPY INTO raw_weather(raw, loaded_at) "
-            "FROM (SELECT $1, METADATA$START_SCAN_TIME FROM @%raw_weather) "
-            "FILE_FORMAT = (TYPE = 'JSON')"
+            "INSERT INTO raw_weather(raw, loaded_at) "
+            "SELECT OBJECT_CONSTRUCT(*), CURRENT_TIMESTAMP() FROM raw_weather_stg"
         )
     finally:
         cur.close()
 
 
-def ingest(mode, locations=None, dry_run=False):
-    """Run ingestion for given locations, falling back to LOCATIONS."""
-    if locations is None:
-        locations = LOCATIONS
+def _location_label(location):
+    """Format a (city, state) tuple or free-form string as a display label."""
+    return location if isinstance(location, str) else f"{location[0]}, {location[1]}"
 
-    conn = None
-    if not dry_run:
-        conn = get_snowflake_connection()
 
-    try:
-        for location in locations:
-            label = location if isinstance(location, str) else f"{location[0]}, {location[1]}"
-            bbox = get_bbox(location)
-            latitudes, longitudes = get_grid_points(bbox)
+def ingest(mode, locations=None, dry_run=False, verbose=False, quiet=False):
+    """Run ingestion for given locations, falling back to LOCATIONS.
+
+    Per-grid-point tables are only printed for dry runs or when verbose; quiet suppresses the per-location output.
+    """
+    if locations is None:
+        locations = LOCATIONS
+    # Repeated locations would otherwise be geocoded, fetched and loaded once per occurrence
+    locations = list(dict.fromkeys(locations))
+    if not locations:
+        return
+
+    # A failing location is reported and skipped so the rest of the run still loads
+    geocoded = []
+    for location in locations:
+        label = _location_label(location)
+        try:
+            geocoded.append((label, get_bbox(location)))
+        except Exception as exc:
+            print(f"Skipping {label}: geocoding failed: {exc!r}", file=sys.stderr)
+
+    if not geocoded:
+        print("No locations could be geocoded, nothing to ingest", file=sys.stderr)
+        return
+
+    # Nominatim allows one request at a time, so only grid resolution is fanned out across threads
+    resolved = []
+    with ThreadPoolExecutor(max_workers=len(geocoded)) as executor:
+        futures = [executor.submit(get_grid_points, bbox) for _, bbox in geocoded]
+        for (label, bbox), future in zip(geocoded, futures):
+            try:
+                latitudes, longitudes = future.result()
+            except Exception as exc:
+                print(f"Skipping {label}: grid point lookup failed: {exc!r}", file=sys.stderr)
+                continue
+            resolved.append((label, bbox, latitudes, longitudes))
+
+    all_lats, all_lons, labels = [], [], []
+    for label, bbox, latitudes, longitudes in resolved:
+        if not quiet:
             print(f"\n{'='*60}")
             print(f"Location: {label} | Mode: {mode}")
             print(f"Bounding Box: {bbox}")
             print(f"Grid Points: {len(latitudes)}")
             print(f"{'='*60}")
+        all_lats.extend(latitudes)
+        all_lons.extend(longitudes)
+        labels.extend([label] * len(latitudes))
+
+    if not all_lats:
+        print("No grid points found for the requested locations, nothing to ingest")
+        return
+
+    responses = get_weather(all_lats, all_lons, mode=mode)
+    parsed = parse_responses(responses, labels)
+
+    if dry_run or verbose:
+        for hourly_data in parsed:
+            # Only materialize and format a DataFrame when there is someone to read the printout
+            print(
+                f"\nLocation: {hourly_data['location']} | "
+                f"Coordinates: {hourly_data['latitude']}°N {hourly_data['longitude']}°E"
+            )
+            print(pd.DataFrame(data=hourly_data).to_string(index=False))
+
+    combined = responses_to_dataframe(parsed, mode)
+    if not quiet:
+        print(f"\nPrepared {len(combined)} rows across {len(resolved)} locations")
 
-            responses = get_weather(latitudes, longitudes, mode=mode)
-            dataframes = parse_responses(responses, label)
-
-            for df in dataframes:
-                df: pd.DataFrame
-                lat = df["latitude"].iloc[0]
-                lon = df["longitude"].iloc[0]
-                print(f"\nCoordinates: {lat}°N {lon}°E")
-                print(df)
-
-            json_path = responses_to_json(dataframes, label, mode)
-            print(f"\nJSON written to: {json_path}")
-
-            if not dry_run:
-                upload_to_snowflake(conn, json_path)
-                print(f"Uploaded to Snowflake @%raw_weather")
-
-            os.remove(json_path)
-    finally:
-        if conn:
+    if not dry_run:
+        conn = get_snowflake_connection()
+        try:
+            upload_to_snowflake(conn, combined)
+        finally:
             conn.close()
+        print(f"Uploaded {len(combined)} rows to Snowflake raw_weather")
 
 
 def parse_location_arg(value):
@@ -238,5 +351,16 @@ if __name__ == "__main__":
         action="store_true",
         help="Skip Snowflake upload, just fetch and print data.",
     )
+    verbosity = parser.add_mutually_exclusive_group()
+    verbosity.add_argument(
+        "--verbose",
+        action="store_true",
+        help="Print the fetched data for every grid point (always on with --dry-run).",
+    )
+    verbosity.add_argument(
+        "--quiet",
+        action="store_true",
+        help="Suppress per-location output, e.g. for cron.",
+    )
     args = parser.parse_args()
-    ingest(args.mode, locations=args.location, dry_run=args.dry_run)
+    ingest(args.mode, locations=args.location, dry_run=args.dry_run, verbose=args.verbose, quiet=args.quiet)